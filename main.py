@@ -6,7 +6,7 @@ import tensorflow.compat.v1 as tf
 from tensorflow.python.tpu import tpu_config, tpu_estimator
 from tensorflow_estimator.python.estimator import estimator as estimator_lib
 from utils import save_config, expand_attention_types_params, yes_or_no, remove_gs_or_filepath, setup_logging, \
-    check_dataset
+    check_dataset, tensor_parallel_mesh
 from inputs import sequential_input, pred_input, handle_pred_output, mlm_sample_text, generic_text
 from export import export_model
 from model_fns import model_fn
@@ -26,11 +26,12 @@ def parse_args():
                         help="If training on GPU, can specify your GPU names in a list - i.e 'device:GPU:0 device:GPU:1'")
     parser.add_argument("--model", type=str, default=None, help="JSON file that contains model parameters.")
     parser.add_argument("--steps_per_checkpoint", type=int, default=5000, help="Save a model checkpoint every X steps.")
-    parser.add_argument("--auto_layout", action="store_true", help="If set, generates and prints the most memory "
-                                                                   "efficient layout according to MTF auto layout.")
+    parser.add_argument("--auto_layout", action="store_true", help="If set, generates the most memory efficient "
+                                                                   "layout according to MTF auto layout, caches it in "
+                                                                   "model_path and trains with it.")
     parser.add_argument("--auto_layout_and_mesh_shape", action="store_true",
-                        help="If set, generates and prints the most memory efficient layout and mesh shape according to"
-                             " MTF auto layout.")
+                        help="If set, generates the most memory efficient layout and mesh shape according to MTF auto "
+                             "layout, caches them in model_path and trains with them.")
     parser.add_argument("--new", action="store_true", help="If set, deletes previous checkpoint, if it exists, and "
                                                            "starts a new training run")
     parser.add_argument("--predict", action="store_true", help="If set, uses the model to predict rather than train.")
@@ -97,6 +98,11 @@ def main(args):
     # Add to params: auto_layout, auto_layout_and_mesh_shape, use_tpu, num_cores
     mesh_shape = mtf.convert_to_shape(params["mesh_shape"])
     params["num_cores"] = mesh_shape.size
+    if params.get("tensor_parallel_size", 1) > 1:
+        # Replace the configured mesh with a 2-D data x tensor parallel mesh over the same number of cores
+        params["mesh_shape"], params["layout"] = tensor_parallel_mesh(params["num_cores"],
+                                                                      params["tensor_parallel_size"],
+                                                                      params["n_vocab"], params["n_head"])
     params["auto_layout"] = args.auto_layout
     params["auto_layout_and_mesh_shape"] = args.auto_layout_and_mesh_shape
     params["use_tpu"] = True if not args.tpu is None else False
@@ -3,38 +3,145 @@ import tensorflow.compat.v1 as tf
 from tensorflow.python.tpu import tpu_estimator
 import mesh_tensorflow.transformer as mtf_transformer
 from optimizers import get_optimizer
-from utils import (create_host_call, get_graph_info, remove_batch_from_layout, simd_mesh_setup, add_mode_to_params,
-                   get_batch_size, auto_layout, auto_layout_and_mesh_shape)
+from utils import (create_host_call, get_graph_info, remove_batch_from_layout, mesh_setup, add_mode_to_params,
+                   get_batch_size, auto_layout, auto_layout_and_mesh_shape, load_auto_layout, save_auto_layout)
 from models.utils import biasmask_attn_weights
 from tensorflow.python.ops import resources
 from sample import sample_autoregressive
 from models.gpt2 import gpt2
 import math
+import weakref
+from collections import namedtuple
+from contextlib import ExitStack
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+
+class GPTNeoParams(NamedTuple):
+    """Read-only view of the params model_fn itself reads, resolved once per call.
+
+    The params dict is still what gets passed into the model, since it's mutated per mode (mode, num_microbatches).
+    """
+    n_embd: int
+    n_vocab: int
+    n_ctx: int
+    mesh_shape: str
+    layout: str
+    model_path: str
+    use_tpu: bool
+    model: str
+    num_cores: int
+    steps_per_checkpoint: int
+    precision: Optional[str] = None
+    causal: Optional[bool] = None
+    eos_id: Optional[int] = None
+    auto_layout: Optional[bool] = None
+    auto_layout_and_mesh_shape: Optional[bool] = None
+    tokens_per_mb_per_replica: Optional[int] = None
+    xla_jit: Optional[bool] = None
+    log_grads: Optional[bool] = None
+    eval_task: Optional[str] = None
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(**{k: params[k] for k in cls._fields if params.get(k) is not None})
+
+
+ModelDims = namedtuple("ModelDims", ["batch_dim", "length_dim", "memory_length_dim", "embd_dim", "vocab_dim",
+                                     "embed_sequence_dim"])
+
+
+@lru_cache(maxsize=None)
+def _dims_for(batch_size, n_ctx, n_embd, n_vocab):
+    # mtf Dimensions are plain (name, size) tuples that only depend on params, so build them once per configuration
+    # (batch size differs between modes) rather than on every model_fn call
+    return ModelDims(
+        batch_dim=mtf.Dimension("batch", batch_size),
+        length_dim=mtf.Dimension("sequence", n_ctx),
+        memory_length_dim=mtf.Dimension("memory_length", n_ctx),
+        embd_dim=mtf.Dimension("embd", n_embd),
+        vocab_dim=mtf.Dimension("vocab", n_vocab),
+        # We need this because gathering when both the args have the same dimension in them breaks things
+        # This dim is specifically for the weights
+        # This prevents the "Einsum has lhs dimension without corresponding rhs or output dimension." error
+        embed_sequence_dim=mtf.Dimension("embed_sequence", n_ctx))
+
+
+# Scaffolds built per lowering, so calling scaffold_fn more than once doesn't add duplicate local_init_op / ready_op
+# nodes to the graph
+_SCAFFOLD_CACHE = weakref.WeakKeyDictionary()
+
+
+def get_ready_op():
+    # Kept in the graph's READY_OP collection, so the check over every global variable & resource is only built once
+    # per graph
+    ready_ops = tf.get_collection(tf.GraphKeys.READY_OP)
+    if ready_ops:
+        return ready_ops[0]
+    ready_op = tf.concat(
+        [tf.report_uninitialized_variables(),
+         resources.report_uninitialized_resources()],
+        axis=0,
+        name="mtf_ready_op")
+    tf.add_to_collection(tf.GraphKeys.READY_OP, ready_op)
+    return ready_op
+
+
+def get_scaffold(lowering):
+    if lowering not in _SCAFFOLD_CACHE:
+        _SCAFFOLD_CACHE[lowering] = tf.train.Scaffold(
+            local_init_op=tf.group(
+                tf.train.Scaffold.default_local_init_op(),
+                lowering.copy_masters_to_slices(),
+                name="mtf_local_init_op"),
+            ready_op=get_ready_op())
+    return _SCAFFOLD_CACHE[lowering]
+
+
+def lower_graph(graph, mesh, mesh_impl, cfg):
+    # mtf ops only become tf ops once the graph is lowered, so this is where XLA jit / device placement is applied
+    with ExitStack() as stack:
+        if cfg.xla_jit and not cfg.use_tpu:
+            # TPU computations are always compiled with XLA already
+            stack.enter_context(tf.xla.experimental.jit_scope(compile_ops=True))
+        if not cfg.use_tpu and mesh_impl.size == 1:
+            # With a single device there's nothing to split - pin the ops mtf doesn't place itself (imports / exports,
+            # loop glue) to that device as well, rather than leaving them to default placement. Master variables are
+            # created at graph build time, so they're placed by the variable placer from mesh_setup instead
+            stack.enter_context(tf.device(mesh_impl.devices[0]))
+        return mtf.Lowering(graph, {mesh: mesh_impl}, autostack=True)
 
 
 def model_fn(features, labels, mode, params):
     # Get global step
     global_step = tf.train.get_global_step()
+    cfg = GPTNeoParams.from_params(params)
 
     # Construct mtf graph + mesh from params
     graph = mtf.Graph()
-    mesh_shape = mtf.convert_to_shape(params["mesh_shape"])
-    layout_rules = mtf.convert_to_layout_rules(params["layout"])
+    mesh_shape = mtf.convert_to_shape(cfg.mesh_shape)
+    layout_rules = mtf.convert_to_layout_rules(cfg.layout)
+
+    # If auto layout was requested, reuse the result of a previous search for this configuration if there is one
+    run_auto_layout = cfg.auto_layout or cfg.auto_layout_and_mesh_shape
+    if run_auto_layout:
+        cached_layout = load_auto_layout(params)
+        if cached_layout is not None:
+            layout_rules, mesh_shape = cached_layout
+            run_auto_layout = False
 
     # Mesh setup
-    if params["use_tpu"]:
-        var_placer, mesh_impl = simd_mesh_setup(params, mesh_shape, layout_rules)
-    else:
-        var_placer = None
-        gpu_ids = params["gpu_ids"]
-        mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
-            mesh_shape, layout_rules, gpu_ids)
+    var_placer, mesh_impl = mesh_setup(params, mesh_shape, layout_rules)
 
     # Trainable variable precision
     # Store to checkpoints in master type, train in slice type, compute in activation type
-    if params["precision"] == "bfloat16":
+    if cfg.precision == "bfloat16":
         variable_dtype = mtf.VariableDType(master_dtype=tf.bfloat16, slice_dtype=tf.float32,
                                            activation_dtype=tf.bfloat16)
+    elif cfg.precision == "mixed_bfloat16":
+        # fp32 checkpoints & weight updates, bf16 matmuls. Norm statistics & the loss are still computed in fp32
+        variable_dtype = mtf.VariableDType(master_dtype=tf.float32, slice_dtype=tf.float32,
+                                           activation_dtype=tf.bfloat16)
     else:
         variable_dtype = mtf.VariableDType(master_dtype=tf.float32, slice_dtype=tf.float32, activation_dtype=tf.float32)
 
@@ -44,44 +151,48 @@ def model_fn(features, labels, mode, params):
     # Build mtf_features & seq length dict for getting number of microbatches
     # We need to pack inputs into a dict to pass into serialize_training_step
     features_dict = {"inputs": features, "labels": labels}
-    sequence_length_dict = {"inputs": params["n_ctx"], "labels": params["n_ctx"]}
+    sequence_length_dict = {"inputs": cfg.n_ctx, "labels": cfg.n_ctx}
 
     params = add_mode_to_params(params, mode)
     batch_size = get_batch_size(params)
 
-    batch_dim = mtf.Dimension("batch", batch_size)
+    # Get the mtf Dimensions for this batch size - cached, since they only depend on params
+    batch_dim, length_dim, memory_length_dim, embd_dim, vocab_dim, embed_sequence_dim = _dims_for(
+        batch_size, cfg.n_ctx, cfg.n_embd, cfg.n_vocab)
     batch_dims = [batch_dim]
-    feature_length = sequence_length_dict["inputs"]
-    length_dim = mtf.Dimension("sequence", feature_length)
 
-    mtf_features = {}
+    feature_shape = mtf.Shape(batch_dims + [length_dim])
+    tf_features = {}
     for key, x in features_dict.items():
         if x is not None:
-            feature_shape = mtf.Shape(batch_dims + [length_dim])
             if type(features_dict[key]) == dict:
                 features_dict[key] = features_dict[key]["feature"]
-            x = tf.cast(features_dict[key], tf.int32)
-            x = tf.reshape(x, feature_shape.to_integer_list)
+            x = tf.cast(features_dict[key], tf.int32)  # No-op if the input pipeline already yields int32
+            if not (x.shape.is_fully_defined() and x.shape.as_list() == feature_shape.to_integer_list):
+                x = tf.reshape(x, feature_shape.to_integer_list)
+            tf_features[key] = x
+
+    mtf_features = {}
+    if len(tf_features) > 1:
+        # Inputs & labels have the same shape, so import them as one stacked tensor rather than one import per feature
+        io_dim = mtf.Dimension("io", len(tf_features))
+        stacked = mtf.import_fully_replicated(
+            mesh, tf.stack(list(tf_features.values())), mtf.Shape([io_dim] + feature_shape.dims), name="io")
+        mtf_features = dict(zip(tf_features.keys(), mtf.unstack(stacked, io_dim)))
+    else:
+        for key, x in tf_features.items():
             mtf_features[key] = mtf.import_fully_replicated(
                 mesh, x, feature_shape, name=key)
 
     # Instantiate dict for dimensions, bias, etc that can be calculated here once then passed into model
     other_features = {}
-    memory_length_dim = mtf.Dimension("memory_length", length_dim.size)
 
-    attn_bias = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype) if params["causal"] else None
+    attn_bias = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype) if cfg.causal else None
 
     # Add attn_bias into mtf_features
     other_features["attn_bias"] = attn_bias
 
-    # Define other Dimensions that we'll need inside the model
-    embd_dim = mtf.Dimension("embd", params["n_embd"])
-    vocab_dim = mtf.Dimension("vocab", params["n_vocab"])
-    # We need this because gathering when both the args have the same dimension in them breaks things
-    # This dim is specifically for the weights
-    # This prevents the "Einsum has lhs dimension without corresponding rhs or output dimension." error
-    embed_sequence_dim = mtf.Dimension("embed_sequence", params["n_ctx"])
-
+    # Add the other Dimensions that we'll need inside the model
     other_features["embd_dim"] = embd_dim
     other_features["vocab_dim"] = vocab_dim
     other_features["embed_sequence_dim"] = embed_sequence_dim
@@ -98,7 +209,7 @@ def model_fn(features, labels, mode, params):
         if not export:
             mtf_samples = sample_autoregressive(
                 inputs, other_features=other_features, params=params, variable_dtype=variable_dtype,
-                remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=params["eos_id"],
+                remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=cfg.eos_id,
                 sampling_use_entmax=params['sampling_use_entmax'], max_steps=params["predict_max_steps"])
 
         else:
@@ -109,29 +220,17 @@ def model_fn(features, labels, mode, params):
 
         mtf_samples = mtf.anonymize(mtf_samples)
         inputs = mtf.anonymize(inputs)
-        lowering = mtf.Lowering(graph, {mesh: mesh_impl}, autostack=True)
+        lowering = lower_graph(graph, mesh, mesh_impl, cfg)
         inputs = lowering.export_to_tf_tensor(inputs)
         outputs = lowering.export_to_tf_tensor(mtf_samples)
         predictions = {
             "inputs": inputs,
             "outputs": outputs}
 
-        def scaffold_fn():
-            return tf.train.Scaffold(
-                local_init_op=tf.group(
-                    tf.train.Scaffold.default_local_init_op(),
-                    lowering.copy_masters_to_slices(),
-                    name="mtf_local_init_op"),
-                ready_op=tf.concat(
-                    [tf.report_uninitialized_variables(),
-                     resources.report_uninitialized_resources()],
-                    axis=0,
-                    name="mtf_ready_op"))
-
         return tpu_estimator.TPUEstimatorSpec(
             mode=tf.estimator.ModeKeys.PREDICT,
             predictions=predictions,
-            scaffold_fn=scaffold_fn,
+            scaffold_fn=lambda: get_scaffold(lowering),
             prediction_hooks=[mtf.MtfRestoreHook(lowering)])
 
     # We're not predicting, so we better be training or evaluating
@@ -145,7 +244,7 @@ def model_fn(features, labels, mode, params):
                                                                                 mesh_shape=mesh_shape,
                                                                                 layout_rules=layout_rules,
                                                                                 tokens_per_microbatch_per_replica=
-                                                                                params["tokens_per_mb_per_replica"]))
+                                                                                cfg.tokens_per_mb_per_replica))
     else:
         num_microbatches = 1
 
@@ -155,38 +254,45 @@ def model_fn(features, labels, mode, params):
 
         # For serialize_training_step we need to modify the model to output results in a dict
         def serialized_fn(mtf_features):
-            if params["model"] == "GPT":
+            if cfg.model == "GPT":
                 with tf.variable_scope('gpt2'):
-                    logits, loss, loss_batch = gpt2.model(mtf_features, other_features, params, mesh,
-                                                          variable_dtype=variable_dtype)
-                return {"logits": logits, "loss": loss, "loss_batch": loss_batch}
+                    _, loss, _ = gpt2.model(mtf_features, other_features, params, mesh, variable_dtype=variable_dtype)
+                # Only return the loss - every output with a batch dim becomes a full-batch accumulator in the
+                # microbatch while_loop, and training never reads the [batch, sequence, vocab] logits
+                return {"loss": loss}
             else:
-                raise Exception(f"'{params['model']}' is not a valid model - please select from [GPT]")
+                raise Exception(f"'{cfg.model}' is not a valid model - please select from [GPT]")
 
         # Serialize the training step - Gradients are accumulated locally and reduced once.
+        # The microbatches run inside one mtf.while_loop, and gradients that lower to lazy allreduce sums are summed
+        # per replica across iterations, then all-reduced a single time after the last microbatch (mtf's equivalent of
+        # DDP's no_sync). The model already divides the loss by num_microbatches, so the summed grads need no rescaling.
         var_grads, output_dict = mtf.serialize_training_step(mtf_features, serialized_fn, batch_dim, num_microbatches)
         loss = output_dict["loss"]
-        loss_batch = output_dict["loss_batch"]
-        logits = output_dict["logits"]
+        logits = None
     else:
         # If we're not splitting into microbatches, return logits & loss as is
-        if params["model"] == "GPT":
+        if cfg.model == "GPT":
             with mtf.utils.outside_all_rewrites():
                 with tf.variable_scope('gpt2'):
                     logits, loss, loss_batch = gpt2.model(mtf_features, other_features, params, mesh,
                                                           variable_dtype=variable_dtype, context=None)
         else:
-            raise Exception(f"'{params['model']}' is not a valid model - please select from [GPT]")
+            raise Exception(f"'{cfg.model}' is not a valid model - please select from [GPT]")
 
     # Auto layout generation
-    if params["auto_layout"]:
-        auto_layout(graph, mesh_shape, logits, loss)
-    if params["auto_layout_and_mesh_shape"]:
-        auto_layout_and_mesh_shape(graph, params["num_cores"], logits, loss)
+    if run_auto_layout:
+        if cfg.auto_layout_and_mesh_shape:
+            layout_rules, mesh_shape = auto_layout_and_mesh_shape(graph, cfg.num_cores, logits, loss)
+        else:
+            layout_rules = auto_layout(graph, mesh_shape, logits, loss)
+        save_auto_layout(params, layout_rules, mesh_shape)
+        # Nothing has been lowered yet, so we only need to re-derive the mesh impl to use the selected layout
+        _, mesh_impl = mesh_setup(params, mesh_shape, layout_rules)
 
     if mode == tf.estimator.ModeKeys.TRAIN:
         # In TRAIN mode, get optimizer
-        if params["num_microbatches"] > 1:
+        if num_microbatches > 1:
             # If we are splitting the batch into microbatches, var grads are created in the serialize_training_step fn
             # So we pass them in here
             _, update_ops, var_grads = get_optimizer(mesh, loss, params, variable_dtype=variable_dtype,
@@ -197,31 +303,44 @@ def model_fn(features, labels, mode, params):
         # Log summaries to tensorboard
         mtf.scalar_summary("loss", loss)
         # Log gradients if in params
-        if params["log_grads"] not in [None, False]:
+        if cfg.log_grads not in [None, False]:
             for g in var_grads:
                 grad_norm = mtf.sqrt(mtf.reduce_sum(mtf.square(g)))
                 mtf.scalar_summary("grads/norm" + g.name[:-2], grad_norm)
     else:
         # For now, we can only export fully-replicated tensors.
         # This has to be done before lowering or they will not be included in the graph
-        mean_logits = mtf.reduce_mean(logits, reduced_dim=vocab_dim)
-        max_logits = mtf.argmax(logits, vocab_dim)
+        # Reduce everything the eval metrics need to scalars inside mtf, so we never all-gather [batch, sequence] tensors
+        eval_task = cfg.eval_task
+        mean_logits = mtf.reduce_mean(logits, output_shape=mtf.Shape([]))
+        eval_scalars = {"loss": loss, "mean_logits": mean_logits}
+        if eval_task == "lambada":
+            # Count / sum over the answer positions (every label that isn't eos) inside mtf too
+            mtf_labels = mtf_features["labels"]
+            answer_mask = mtf.to_float(mtf.not_equal(mtf_labels, cfg.eos_id))
+            correct = mtf.to_float(mtf.equal(mtf.argmax(logits, vocab_dim), mtf_labels))
+            eval_scalars["num_answers"] = mtf.reduce_sum(answer_mask, output_shape=mtf.Shape([]))
+            eval_scalars["num_correct"] = mtf.reduce_sum(correct * answer_mask, output_shape=mtf.Shape([]))
+            eval_scalars["answer_loss"] = mtf.reduce_sum(mtf.to_float(loss_batch) * answer_mask,
+                                                         output_shape=mtf.Shape([]))
+        else:
+            eval_scalars["mean_loss"] = mtf.reduce_mean(loss_batch, output_shape=mtf.Shape([]))
         del logits
-        fully_replicated_mean_logits = mtf.anonymize(mean_logits)
-        fully_replicated_max_logits = mtf.anonymize(max_logits)
-        fully_replicated_loss_batch = mtf.anonymize(loss_batch)
+        # Stack the scalars so they're exported together rather than with one export each
+        stacked_eval_scalars = mtf.stack([mtf.to_float(t) for t in eval_scalars.values()], "eval_scalars")
 
     # Gets & prints info about no. trainable vars in the model & dimension names
     get_graph_info(graph)
 
     # 'lowers' mtf tensors into a tf graph - this enables us to export results as tf tensors
-    lowering = mtf.Lowering(graph, {mesh: mesh_impl}, autostack=True)
-    tf_loss = lowering.export_to_tf_tensor(loss)
-    tf_loss = tf.cast(tf_loss, tf.float32)
+    lowering = lower_graph(graph, mesh, mesh_impl, cfg)
 
     if mode == tf.estimator.ModeKeys.TRAIN:
+        tf_loss = lowering.export_to_tf_tensor(loss)
+        tf_loss = tf.cast(tf_loss, tf.float32)
+
         # Use our patched version until mtf updates theirs
-        host_call = create_host_call(params['model_path'])
+        host_call = create_host_call(cfg.model_path)
         mtf.utils.remove_summaries()
 
         # Creates train_op
@@ -230,9 +349,11 @@ def model_fn(features, labels, mode, params):
         tf.logging.info(f"tf_update_ops: {tf_update_ops}")
         train_op = tf.group(tf_update_ops)
     else:
-        tf_mean_logits = lowering.export_to_tf_tensor(fully_replicated_mean_logits)
-        tf_max_logits = lowering.export_to_tf_tensor(fully_replicated_max_logits)
-        tf_loss_batch = tf.to_float(lowering.export_to_tf_tensor(fully_replicated_loss_batch))
+        # Split back into [1] shaped tensors - TPUEstimator concatenates eval metric tensors from all shards along
+        # their first dimension, so the (fully replicated) scalars need one
+        tf_eval_scalars = lowering.export_to_tf_tensor(stacked_eval_scalars)
+        tf_eval_scalars = dict(zip(eval_scalars.keys(), tf.split(tf_eval_scalars, len(eval_scalars))))
+        tf_loss = tf.reshape(tf_eval_scalars["loss"], [])
 
     with mtf.utils.outside_all_rewrites():
         # Copy master variables to slices. Must be called first.
@@ -249,8 +370,8 @@ def model_fn(features, labels, mode, params):
             tf.add_to_collection(tf.GraphKeys.SAVERS, saver)
             saver_listener = mtf.MtfCheckpointSaverListener(lowering)
             saver_hook = tf.train.CheckpointSaverHook(
-                params["model_path"],
-                save_steps=params["steps_per_checkpoint"],
+                cfg.model_path,
+                save_steps=cfg.steps_per_checkpoint,
                 saver=saver,
                 listeners=[saver_listener])
 
@@ -271,32 +392,28 @@ def model_fn(features, labels, mode, params):
                 bpb = loss * (0.29335 / math.log(2))
                 return tf.metrics.mean(bpb)
 
-            def _metric_fn(tf_mean_logits, tf_loss_batch):
+            def _metric_fn(tf_mean_logits, tf_mean_loss):
                 mean_logits = tf.metrics.mean(tf_mean_logits)
-                loss = tf.reduce_mean(tf_loss_batch)
-                perp = _perplexity(loss)
-                bpb = _bits_per_byte(loss)
+                perp = _perplexity(tf_mean_loss)
+                bpb = _bits_per_byte(tf_mean_loss)
                 return {"mean_logits": mean_logits, "perplexity": perp, "bits per byte": bpb}
 
-            def _lambada_metric_fn(labels, tf_max_logits, tf_loss_batch):
-                eos_token = params["eos_id"]
-                answer_positions = tf.where(tf.math.not_equal(labels, eos_token))
-
-                correct_answers = tf.gather_nd(tf.math.equal(tf_max_logits, labels), answer_positions)
-                accuracy = tf.metrics.mean(tf.cast(correct_answers, tf.float32))
+            def _lambada_metric_fn(tf_num_answers, tf_num_correct, tf_answer_loss):
+                # Weighting each batch's mean by its number of answers gives the mean over all answer positions
+                num_answers = tf.maximum(tf_num_answers, 1.)
+                accuracy = tf.metrics.mean(tf_num_correct / num_answers, weights=tf_num_answers)
 
-                # I guess tf_loss_batch has z_loss and maybe other stuff added to it
+                # I guess tf_answer_loss has z_loss and maybe other stuff added to it
                 # so maybe this should be calculated separately in the future
-                answer_loss = tf.gather_nd(tf_loss_batch, answer_positions)
-                log_perplexity = tf.metrics.mean(answer_loss)
+                log_perplexity = tf.metrics.mean(tf_answer_loss / num_answers, weights=tf_num_answers)
 
                 return {"lambada_acc": accuracy, "lambada_log_ppl": log_perplexity}
 
-            eval_task = params["eval_task"]
             if eval_task == "lambada":
-                eval_metrics = (_lambada_metric_fn, [labels, tf_max_logits, tf_loss_batch])
+                eval_metrics = (_lambada_metric_fn, [tf_eval_scalars["num_answers"], tf_eval_scalars["num_correct"],
+                                                     tf_eval_scalars["answer_loss"]])
             else:
-                eval_metrics = (_metric_fn, [tf_mean_logits, tf_loss_batch])
+                eval_metrics = (_metric_fn, [tf_eval_scalars["mean_logits"], tf_eval_scalars["mean_loss"]])
 
             return tpu_estimator.TPUEstimatorSpec(
                 tf.estimator.ModeKeys.EVAL,
@@ -1,8 +1,19 @@
 import mesh_tensorflow as mtf
 import tensorflow.compat.v1 as tf
+import math
 import random
 
-BASE_FNS = {'gelu': mtf.gelu,
+
+def _gelu(x):
+    # Same tanh approximation as mtf.gelu, but as a single mtf op, so it lowers to one tf subgraph XLA can fuse
+    # rather than a chain of separate elementwise mtf ops
+    def gelu_fn(t):
+        return 0.5 * t * (1.0 + tf.tanh(math.sqrt(2 / math.pi) * (t + 0.044715 * t * t * t)))
+
+    return mtf.cwise(gelu_fn, [x], name="gelu")
+
+
+BASE_FNS = {'gelu': _gelu,
             'relu': mtf.relu,
             'sigmoid': mtf.sigmoid,
             'tanh': mtf.tanh,
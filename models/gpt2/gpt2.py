@@ -2,46 +2,59 @@
 import tensorflow.compat.v1 as tf
 import mesh_tensorflow.transformer as mtf_transformer
 
-from models.utils import parse_inputs, entmax_cross_entropy_with_logits
+from models.utils import parse_inputs, entmax_cross_entropy_with_logits, biasmask_decode_attn_weights, \
+    softmax_cross_entropy_with_logits, sparse_softmax_cross_entropy_with_logits
 from models.layers import *
 
 
 # --------------------------------------------------------------------------------
 # TRANSFORMER BLOCK:
 
-def block(params, scope, layer_num, bias, sequence_dim, memory_length_dim, pos_emb, variable_dtype, context=None):
+def moe_hparams(params):
+    moe_params = mtf.transformer.moe.HParams()
+    mtf.transformer.moe.set_default_moe_hparams(moe_params)
+    moe_params.add_hparam("moe_min_expert_capacity", 1)
+    moe_params.add_hparam("moe_use_experts_attention", False)
+
+    # Override defaults
+    for k, v in params["moe_params"].items():
+        moe_params.add_hparam(k, v)
+    return moe_params
+
+
+def block(params, scope, layer_num, bias, sequence_dim, memory_length_dim, pos_emb, variable_dtype, context=None,
+          moe_params=None):
+    # Everything that only depends on the layer is decided here, once, rather than each time fn is traced
     use_mlp_glu = params["mlp_glu"] == True
     use_scale_norm = params["scalenorm"] == True
     use_moe = exists(params["moe_layers"]) and (layer_num in params["moe_layers"])
     use_rezero = params["rezero"] == True
     macaron_attention = params["macaron"] == True
+    attention_type = params["attention_types"][layer_num]
 
-    def fn(x):
-        with tf.variable_scope(scope):
-            nx = x.shape[-1]  # Grab last dimension from input
+    if use_rezero:
+        prenorm = identity
+    elif use_scale_norm:
+        prenorm = scale_norm
+    else:
+        prenorm = layer_norm
 
-            if use_rezero:
-                prenorm = identity
-            elif use_scale_norm:
-                prenorm = scale_norm
-            else:
-                prenorm = layer_norm
+    pre_residual_fn = rezero if use_rezero else identity
+
+    mlp_fn = mlp_glu if use_mlp_glu else mlp
+    intermediate_size = params["n_embd"] * 4 * (1 if not use_mlp_glu else 2)
+    # Define intermediate layer of mlp - to split
+    dim_intermediate_expanded = mtf.Dimension("intermediate_expanded", intermediate_size)
 
-            pre_residual_fn = rezero if use_rezero else identity
+    mult = 0.5 if macaron_attention else 1
 
-            attention_type = params["attention_types"][layer_num]
+    def fn(x):
+        with tf.variable_scope(scope):
+            nx = x.shape[-1]  # Grab last dimension from input
 
             if macaron_attention:
-                mult = 0.5
-                mlp_fn = mlp_glu if use_mlp_glu else mlp
-                intermediate_size = nx.size * 4 * (1 if not use_mlp_glu else 2)
-                # Define intermediate layer of mlp - to split
-                dim_intermediate_expanded = mtf.Dimension("intermediate_expanded", intermediate_size)
                 m = mlp_fn(x, "mlp_macaron", dim_intermediate_expanded, variable_dtype=variable_dtype, params=params)
-
                 x = x + (m * mult)
-            else:
-                mult = 1
 
             if attention_type != "none":
                 res_x = prenorm(x, "norm_1", variable_dtype=variable_dtype, params=params)
@@ -56,15 +69,6 @@ def block(params, scope, layer_num, bias, sequence_dim, memory_length_dim, pos_e
             res_x = prenorm(x, "norm_2", variable_dtype=variable_dtype, params=params)
 
             if use_moe:
-                moe_params = mtf.transformer.moe.HParams()
-                mtf.transformer.moe.set_default_moe_hparams(moe_params)
-                moe_params.add_hparam("moe_min_expert_capacity", 1)
-                moe_params.add_hparam("moe_use_experts_attention", False)
-
-                # Override defaults
-                for k, v in params["moe_params"].items():
-                    moe_params.add_hparam(k, v)
-
                 moe_train = params["mode"] == "train"
 
                 m, aux_loss = mtf.transformer.moe.transformer_moe_layer_v1(res_x, x.shape[-1], moe_params,
@@ -76,14 +80,9 @@ def block(params, scope, layer_num, bias, sequence_dim, memory_length_dim, pos_e
                                                                            variable_dtype=variable_dtype,
                                                                            num_microbatches=params["num_microbatches"])
                 m = mtf.dropout(m, rate=params["res_dropout"], name="moe_dropout")
+                # The MoE layer returns its loss in the activation dtype - sum it with the others in the slice dtype
+                aux_loss = mtf.cast(aux_loss, variable_dtype.slice_dtype)
             else:
-
-                mlp_fn = mlp_glu if use_mlp_glu else mlp
-                intermediate_size = nx.size * 4 * (1 if not use_mlp_glu else 2)
-
-                # Define intermediate layer of mlp - to split
-                dim_intermediate_expanded = mtf.Dimension("intermediate_expanded", intermediate_size)
-
                 m = mlp_fn(res_x, "mlp", dim_intermediate_expanded, variable_dtype=variable_dtype, params=params)
                 aux_loss = mtf.zeros(x.mesh, mtf.Shape([]), dtype=variable_dtype.slice_dtype)
 
@@ -118,7 +117,7 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
 
     with tf.variable_scope("token_embd"):
         # Text embedding
-        h = mtf.gather(wte, x, vocab_dim)
+        h = embedding_lookup(wte, x, vocab_dim, params)
         if params["embed_dropout"] > 0 and params["mode"] == "train":
             h = mtf.dropout(h, rate=params["embed_dropout"], name="wte_dropout")
 
@@ -126,7 +125,13 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
 
     if use_rotary_emb:
         wpe = None
-        layer_pos_emb = rotary_positional_emb(mesh, sequence_dim, params, variable_dtype)
+        cos, sin = rotary_positional_emb(mesh, sequence_dim, params, variable_dtype)
+        if is_incremental_inference(context):
+            # q only needs the rotation for the current position - look it up once here rather than in every layer
+            cos_q, sin_q = map(lambda t: embedding_lookup(t, context.position - 1, sequence_dim, params), (cos, sin))
+        else:
+            cos_q, sin_q = cos, sin
+        layer_pos_emb = (cos, sin, cos_q, sin_q)
     elif use_axial_pos_emb:
         wpe = axial_positional_emb(embd_dim, mesh, params, variable_dtype)
         layer_pos_emb = None
@@ -142,27 +147,54 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
     if exists(wpe):
         with tf.variable_scope("pos_embd"):
             # Positional embedding
-            position_indices = mtf.range(mesh, sequence_dim, tf.int64) if not is_incremental_inference(context) else (
+            position_indices = mtf.range(mesh, sequence_dim, tf.int32) if not is_incremental_inference(context) else (
                     context.position - 1)
-            pos_emb = mtf.gather(wpe, position_indices, wpe.shape[0])
+            if use_axial_pos_emb:
+                pos_emb = axial_positional_emb_lookup(wpe, position_indices, params)
+            else:
+                pos_emb = embedding_lookup(wpe, position_indices, wpe.shape[0], params)
             if params["embed_dropout"] > 0 and params["mode"] == "train":
                 pos_emb = mtf.dropout(pos_emb, rate=params["embed_dropout"], name="wte_dropout")
             h += pos_emb
 
+    attn_bias = other_features["attn_bias"]
+    if is_incremental_inference(context) and exists(attn_bias):
+        # Decoding a single position - build its mask row once per step and share it across all layers
+        attn_bias = biasmask_decode_attn_weights(mesh, context.position - 1, sequence_dim,
+                                                 other_features["memory_length_dim"], variable_dtype)
+
+    if is_incremental_inference(context) and "local" in params["attention_types"]:
+        # The current position's one-hot is the same in every local attention layer - build it once per decode step
+        context.position_one_hot = mtf.one_hot(context.position - 1, sequence_dim,
+                                               dtype=variable_dtype.activation_dtype)
+
     aux_losses = 0  # instantiate auxiliary losses (for MOE models)
+    # The MoE hparams are the same for every MoE layer, so only build them once
+    moe_params = moe_hparams(params) if exists(params["moe_layers"]) else None
+
+    share_parameters = exists(params["share_parameters"]) and params["share_parameters"] == True
+    # With shared parameters, layers only differ by their structure (attention type / MoE), so one block fn is built
+    # per structure and reused, rather than one per layer
+    shared_block_fns = {}
 
     for layer in range(params["n_layer"]):
         # attn blocks
-        share_parameters = exists(params["share_parameters"]) and params["share_parameters"] == True
         block_scope = f"h{layer}" if not share_parameters else ""
-
-        block_fn = block(params=params, scope=block_scope, layer_num=layer,
-                         bias=other_features["attn_bias"],
-                         sequence_dim=sequence_dim,
-                         memory_length_dim=other_features["memory_length_dim"],
-                         pos_emb = layer_pos_emb,
-                         variable_dtype=variable_dtype,
-                         context=context)
+        block_key = (params["attention_types"][layer], exists(params["moe_layers"]) and layer in params["moe_layers"])
+
+        if share_parameters and block_key in shared_block_fns:
+            block_fn = shared_block_fns[block_key]
+        else:
+            block_fn = block(params=params, scope=block_scope, layer_num=layer,
+                             bias=attn_bias,
+                             sequence_dim=sequence_dim,
+                             memory_length_dim=other_features["memory_length_dim"],
+                             pos_emb = layer_pos_emb,
+                             variable_dtype=variable_dtype,
+                             context=context,
+                             moe_params=moe_params)
+            if share_parameters:
+                shared_block_fns[block_key] = block_fn
 
         # If true and in train mode, enable gradient checkpointing
         recompute_grad = params["recompute_grad"] and (params["mode"] == "train") == True
@@ -189,7 +221,13 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
         logits = mtf.cast(logits, tf.float32)
 
         use_entmax_loss = params.get("entmax_loss", False)
-        loss_fn = mtf.layers.softmax_cross_entropy_with_logits if not use_entmax_loss else entmax_cross_entropy_with_logits
+        if use_entmax_loss:
+            loss_fn = entmax_cross_entropy_with_logits
+        elif is_split(vocab_dim, params):
+            loss_fn = softmax_cross_entropy_with_logits
+        else:
+            # The whole vocab is on each core, so the targets can be looked up directly
+            loss_fn = sparse_softmax_cross_entropy_with_logits
 
         with tf.variable_scope("xentropy_final"):
             loss_batch = loss_fn(logits=logits, targets=labels,
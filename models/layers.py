@@ -2,6 +2,7 @@ import mesh_tensorflow as mtf
 import tensorflow.compat.v1 as tf
 import math
 import mesh_tensorflow.transformer as mtf_transformer
+from functools import lru_cache
 
 from models.activations import get_activation_fn
 
@@ -25,9 +26,15 @@ def is_incremental_inference(context):
 
 
 def norm(x, axis, epsilon=1e-8):
+    # Statistics are accumulated in fp32 whatever the activation dtype, and the result cast back
+    dtype = x.dtype
+    x = mtf.cast(x, tf.float32)
+
+    # Two passes - centre first, then take the variance - rather than a single E[x^2] - E[x]^2 pass, which cancels
+    # catastrophically when |mean| >> std, and can't be shifted cheaply when the axis is split across the mesh
     x -= mtf.reduce_mean(x, reduced_dim=axis, name="norm_reduce_mean_u")
     s = mtf.reduce_mean(mtf.square(x), reduced_dim=axis, name="norm_reduce_mean_s")
-    return x * mtf.rsqrt(s + epsilon)
+    return mtf.cast(x * mtf.rsqrt(s + epsilon), dtype)
 
 
 def rezero(x, scope, dtype):
@@ -73,6 +80,36 @@ def layer_norm(x, scope, *, variable_dtype, axis=sentinel, epsilon=1e-5, params=
         return x
 
 
+def is_split(dim, params):
+    """Whether `dim` may be split across the mesh - assumed to be the case whenever the layout is left to auto layout."""
+    if params.get("auto_layout") or params.get("auto_layout_and_mesh_shape"):
+        return True
+    layout_rules = mtf.convert_to_layout_rules(params["layout"])
+    return exists(layout_rules.tensor_dimension_to_mesh_axis(dim, mtf.convert_to_shape(params["mesh_shape"])))
+
+
+def embedding_lookup(weights, indices, dim, params):
+    """
+    mtf.gather(weights, indices, dim), with the forward pass as a real gather rather than a one-hot matmul where the
+    layout allows it. Only the forward pass changes - the backward pass is still mtf.gather's dense one-hot einsum.
+    """
+    if dim != weights.shape[0] or is_split(dim, params):
+        # The slices would only hold part of the table - fall back to the one-hot einsum, which mtf can split
+        return mtf.gather(weights, indices, dim)
+
+    def grad_fn(op, dy):
+        # mtf.gather's dense one-hot einsum backward pass, unchanged - mtf sums the table gradient over any split
+        # indices dims for us
+        return [mtf.einsum([mtf.one_hot(indices, dim, dtype=dy.dtype), dy], output_shape=weights.shape), None]
+
+    return mtf.slicewise(lambda w, i: tf.gather(w, i), [weights, indices],
+                         output_shape=indices.shape + (weights.shape - dim),
+                         output_dtype=weights.dtype,
+                         splittable_dims=indices.shape.dims + (weights.shape - dim).dims,
+                         grad_function=grad_fn,
+                         name="embedding_lookup")
+
+
 def linear_attention(q, k, v):
     batch_dim, seq_dim, head_dim, dim_out = (v.shape[0], v.shape[1], v.shape[2], v.shape[3])
     q = mtf.rename_dimension(q, "features_per_head", "features_per_head_in")
@@ -108,13 +145,65 @@ def causal_linear_attention(q, k, v, eps = 1e-6):
     return attn
 
 
+def chunked_causal_linear_attention(q, k, v, chunk_size, eps=1e-6):
+    """causal_linear_attention, computed a chunk of the sequence at a time.
+
+    Rather than a running sum of k v^T at every position ([batch, seq, heads, d_in, d_out]), only the sums up to the
+    start of each chunk are kept, and positions within a chunk attend to each other directly (causally masked).
+    """
+    batch_dim, seq_dim, head_dim, dim_out = (v.shape[0], v.shape[1], v.shape[2], v.shape[3])
+    q = mtf.rename_dimension(q, "features_per_head", "features_per_head_in")
+    k = mtf.rename_dimension(k, "features_per_head", "features_per_head_in")
+
+    dim_in = k.shape[-1]
+
+    q = mtf.softmax(q, dim_in)
+    k = mtf.exp(k)
+
+    chunk_size = math.gcd(seq_dim.size, chunk_size)
+    dim_chunks = mtf.Dimension("linear_attention_chunks", seq_dim.size // chunk_size)
+    dim_q_chunk = mtf.Dimension("linear_attention_chunk_q", chunk_size)
+    dim_k_chunk = mtf.Dimension("linear_attention_chunk_k", chunk_size)
+    q = mtf.replace_dimensions(q, seq_dim, [dim_chunks, dim_q_chunk])
+    k, v = map(lambda t: mtf.replace_dimensions(t, seq_dim, [dim_chunks, dim_k_chunk]), (k, v))
+
+    # Sums of k and k v^T over all previous chunks
+    k_sum = mtf.reduce_sum(k, reduced_dim=dim_k_chunk)
+    context = mtf.einsum([k, v], output_shape=[batch_dim, dim_chunks, head_dim, dim_in, dim_out])
+    prev_k = mtf.cumsum(k_sum, dim_chunks, exclusive=True)
+    prev_context = mtf.cumsum(context, dim_chunks, exclusive=True)
+
+    # Within a chunk, each position sees itself and the positions before it
+    i = mtf.range(q.mesh, dim_q_chunk, tf.int32)
+    j = mtf.range(q.mesh, dim_k_chunk, tf.int32)
+    i, j = map(lambda t: mtf.broadcast(t, [dim_q_chunk, dim_k_chunk]), (i, j))
+    causal_mask = mtf.cast(mtf.greater_equal(i, j), q.dtype)
+    qk = mtf.einsum([q, k, causal_mask], output_shape=[batch_dim, dim_chunks, dim_q_chunk, dim_k_chunk, head_dim])
+
+    # q sums to one over dim_in, so q . (cumsum(k) + eps) = q . cumsum(k) + eps
+    D = mtf.einsum([q, prev_k], output_shape=[batch_dim, dim_chunks, dim_q_chunk, head_dim]) + \
+        mtf.reduce_sum(qk, reduced_dim=dim_k_chunk) + eps
+
+    output_shape = [batch_dim, dim_chunks, dim_q_chunk, head_dim, dim_out]
+    attn = mtf.einsum([q, prev_context], output_shape=output_shape) + mtf.einsum([qk, v], output_shape=output_shape)
+    attn /= D
+    return mtf.replace_dimensions(attn, [dim_chunks, dim_q_chunk], seq_dim)
+
+
+@lru_cache(maxsize=None)
+def _stddev(w_init_stdev, in_size, n_layer, scale_by_depth, scale_by_in, scale):
+    if scale_by_depth and scale:
+        # Scale by sqrt(num_layers), only happens at the final projection before a res block output
+        w_init_stdev = w_init_stdev * (1. / math.sqrt(n_layer))
+    if scale_by_in:  # Scale by sqrt(num_input_features)
+        w_init_stdev = w_init_stdev * (1. / math.sqrt(in_size))
+    return w_init_stdev
+
+
 def linear(x, scope, nf, *, w_init_stdev=0.02, variable_dtype, params=None, scale=False):
     # nf = number of features
-    if params["scale_by_depth"] and scale:
-        # Scale by sqrt(num_layers), only happens at the final projection before a res block output
-        w_init_stdev = w_init_stdev * (1. / math.sqrt(params["n_layer"]))
-    if params["scale_by_in"]:  # Scale by sqrt(num_input_features)
-        w_init_stdev = w_init_stdev * (1. / math.sqrt(x.shape[-1].size))  # Dimension is a namedtuple of (name, size)
+    w_init_stdev = _stddev(w_init_stdev, x.shape[-1].size, params["n_layer"], bool(params["scale_by_depth"]),
+                           bool(params["scale_by_in"]), scale)  # Dimension is a namedtuple of (name, size)
     # Not in the variable_scope because mtf already has a variable_scope in it
     with tf.variable_scope("conv1d_main"):
         c = mtf.layers.dense(x, new_dims=[nf], reduced_dims=[x.shape[-1]], name=scope, use_bias=True,
@@ -124,33 +213,120 @@ def linear(x, scope, nf, *, w_init_stdev=0.02, variable_dtype, params=None, scal
         return c
 
 
-def memory_key_values(k, v, num_mem_kv, dim_batch, dim_heads, variable_dtype, mesh):
-    """memory / key values from all attention paper"""
+def memory_key_values(num_mem_kv, dim_heads, dim_kv, variable_dtype, mesh):
+    """memory / key values from all attention paper
+
+    These are the same for every example, so they're returned without a batch dimension and attended to separately
+    (see attention_with_memory_kv) rather than being broadcast across the batch and concatenated onto k / v.
+    """
 
     dim_mem_kv = mtf.Dimension("mem_kv_sequence", num_mem_kv)
-    emb_dim = k.shape[-1]
-    mem_std = 1 / math.sqrt(emb_dim.size)
+    mem_std = 1 / math.sqrt(dim_kv.size)
 
-    mem_k = mtf.get_variable(mesh, "mem_k", mtf.Shape([dim_mem_kv, dim_heads, emb_dim]),
+    mem_k = mtf.get_variable(mesh, "mem_k", mtf.Shape([dim_mem_kv, dim_heads, dim_kv]),
                              initializer=tf.random_normal_initializer(stddev=mem_std),
                              master_dtype=variable_dtype.master_dtype,
                              slice_dtype=variable_dtype.slice_dtype,
                              activation_dtype=variable_dtype.activation_dtype,
                              )
-    mem_v = mtf.get_variable(mesh, "mem_v", mtf.Shape([dim_mem_kv, dim_heads, emb_dim]),
+    mem_v = mtf.get_variable(mesh, "mem_v", mtf.Shape([dim_mem_kv, dim_heads, dim_kv]),
                              initializer=tf.random_normal_initializer(stddev=mem_std),
                              master_dtype=variable_dtype.master_dtype,
                              slice_dtype=variable_dtype.slice_dtype,
                              activation_dtype=variable_dtype.activation_dtype)
-
-    mem_k, mem_v = map(lambda t: mtf.broadcast(t, [dim_batch, dim_mem_kv, dim_heads, emb_dim]),
-                       (mem_k, mem_v))
-    mem_k, mem_v = map(lambda t: mtf.rename_dimension(t, "mem_kv_sequence", "sequence"),
-                       (mem_k, mem_v))
-
-    k = mtf.concat([mem_k, k], "sequence")
-    v = mtf.concat([mem_v, v], "sequence")
-    return k, v
+    return mem_k, mem_v
+
+
+def attention_with_memory_kv(q, k, v, mem_k, mem_v, memory_length_dim, key_dim, value_dim, bias=None,
+                             dropout_rate=0.0):
+    """mtf_transformer.attention.attention, additionally attending to the (batch independent) memory key / values."""
+    dim_mem_kv = mem_k.shape.get_dim_by_name("mem_kv_sequence")
+    q, k, mem_k = map(lambda t: mtf.cast(t, tf.float32), (q, k, mem_k))
+
+    logits = mtf.layers.us_einsum([q, k], reduced_dims=[key_dim])
+    if exists(bias):
+        logits += mtf.cast(bias, logits.dtype)
+    # Logits for the memory key / values pick up the batch dimension from q, so mem_k is never tiled
+    mem_logits = mtf.layers.us_einsum([q, mem_k], reduced_dims=[key_dim])
+    mem_logits = mtf.rename_dimension(mem_logits, dim_mem_kv.name, memory_length_dim.name)
+
+    # Normalize over memory + sequence positions jointly, then split the weights back up
+    logits = mtf.concat([mem_logits, logits], memory_length_dim.name)
+    weights = mtf.softmax(logits, logits.shape.get_dim_by_name(memory_length_dim.name))
+    weights = mtf.cast(weights, v.dtype)
+    if dropout_rate != 0.0:
+        weights = mtf.dropout(weights, rate=dropout_rate)
+    mem_weights, weights = mtf.split(weights, weights.shape.get_dim_by_name(memory_length_dim.name),
+                                     [dim_mem_kv.size, memory_length_dim.size])
+    mem_weights = mtf.rename_dimension(mem_weights, memory_length_dim.name, dim_mem_kv.name)
+    weights = mtf.replace_dimensions(weights, weights.shape.get_dim_by_name(memory_length_dim.name),
+                                     memory_length_dim)
+
+    outputs_shape = q.shape - key_dim + value_dim
+    return mtf.einsum([mem_weights, mem_v], outputs_shape) + mtf.einsum([weights, v], outputs_shape)
+
+
+def write_kv_slot(old, new, position, dim_seq):
+    """Writes `new` into `old` at each example's `position` along `dim_seq`.
+
+    `old` is laid out as [batch, dim_seq, ...] and `new` has the same shape minus `dim_seq`. Lowers to a scatter of
+    just the new slot, instead of blending the whole sequence with a one-hot mask.
+    """
+    dim_batch = old.shape[0]
+    if new.shape != old.shape - dim_seq:
+        new = mtf.transpose(new, old.shape - dim_seq)
+    if position.shape != mtf.Shape([dim_batch]):
+        position = mtf.broadcast(position, [dim_batch])
+
+    def _scatter(old, new, position):
+        batch_indices = tf.range(tf.shape(old)[0], dtype=position.dtype)
+        return tf.tensor_scatter_nd_update(old, tf.stack([batch_indices, position], axis=-1), new)
+
+    return mtf.slicewise(_scatter, [old, new, position], output_shape=old.shape, output_dtype=old.dtype,
+                         splittable_dims=old.shape - dim_seq, name="write_kv_slot")
+
+
+class FusedQKVAttentionParams(mtf_transformer.attention.AttentionParams):
+    """AttentionParams storing q, k and v as a single [io, qkv, heads] "qkv" variable, projected with one einsum.
+
+    The weights are stacked along a new, unsplit "qkv" dimension rather than concatenated along "heads", which may be
+    split across the mesh. Checkpoints use a different variable to attention_params_simple's q / k / v, so this is
+    opt in (see the fused_qkv param).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, make_attention_vars=False, **kwargs)
+
+    def init_weights(self):
+        super().init_weights()  # Only creates o, as make_attention_vars is False
+
+        # Same initialization as the separate q / k / v variables
+        if mtf.layers.unit_scaling_convention():
+            q_stddev = kv_stddev = 1.0
+        else:
+            q_stddev = kv_stddev = self.query_input_dim.size ** -0.5
+            if self.fold_scaling_into_initializer:
+                q_stddev *= self.key_dim.size ** -0.5
+
+        def qkv_init(shape, dtype=tf.float32, partition_info=None):
+            stddev = tf.reshape(tf.constant([q_stddev, kv_stddev, kv_stddev], dtype=dtype), [1, 3, 1])
+            return tf.random.normal(shape, dtype=dtype) * stddev
+
+        self.dim_qkv = mtf.Dimension("qkv", 3)
+        self.wqkv = mtf.get_variable(
+            self.mesh,
+            "qkv",
+            [self.query_input_dim, self.dim_qkv, self.q_shape[-1]],
+            initializer=qkv_init,
+            dtype=self.variable_dtype)
+
+    def compute_qkv(self, x):
+        ret = mtf.layers.us_einsum([x, self.wqkv], reduced_dims=[self.query_input_dim])
+        q, k, v = [mtf.replace_dimensions(t, t.shape.dims[-1], dims)
+                   for t, dims in zip(mtf.unstack(ret, self.dim_qkv), (self.q_dims, self.k_dims, self.v_dims))]
+        if not self.fold_scaling_into_initializer:
+            q *= self.key_dim.size ** -0.5
+        return q, k, v
 
 
 def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_length_dim, variable_dtype, context=None, pos_emb=None):
@@ -168,37 +344,44 @@ def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_len
     with tf.variable_scope(scope):
         # Compute attention inputs
         dim_kv = mtf.Dimension("features_per_head", params["n_embd"] // params["n_head"])
-        mtfparams = mtf.transformer.attention.attention_params_simple(
-            x.mesh,
-            io_dim=dim_embd,
-            kv_dim=dim_kv,
-            heads_dim=dim_heads,
-            variable_dtype=variable_dtype
-        )
-        q = mtfparams.compute_q(x)
-        k = mtfparams.compute_k(x)
-        v = mtfparams.compute_v(x)
+        if params.get("fused_qkv", False):
+            mtfparams = FusedQKVAttentionParams(
+                x.mesh,
+                query_input_dim=dim_embd,
+                memory_input_dim=dim_embd,
+                output_dim=dim_embd,
+                key_dim=dim_kv,
+                value_dim=dim_kv,
+                query_heads_dims=[dim_heads],
+                memory_heads_dims=[dim_heads],
+                variable_dtype=variable_dtype
+            )
+            q, k, v = mtfparams.compute_qkv(x)
+        else:
+            mtfparams = mtf.transformer.attention.attention_params_simple(
+                x.mesh,
+                io_dim=dim_embd,
+                kv_dim=dim_kv,
+                heads_dim=dim_heads,
+                variable_dtype=variable_dtype
+            )
+            q = mtfparams.compute_q(x)
+            k = mtfparams.compute_k(x)
+            v = mtfparams.compute_v(x)
 
         if is_incremental_inference(context):
-            one_hot = mtf.one_hot(context.position - 1, dim_seq, dtype=variable_dtype.master_dtype)
-            inv_one_hot = 1.0 - one_hot
             old_k, old_v = context.get_states(2)
-            k = old_k * inv_one_hot + k * one_hot
-            v = old_v * inv_one_hot + v * one_hot
+            k = write_kv_slot(old_k, k, context.position - 1, dim_seq)
+            v = write_kv_slot(old_v, v, context.position - 1, dim_seq)
 
         if exists(context):
             context.record_new_states([k, v])
 
         if exists(pos_emb):
-            cos, sin = pos_emb
+            # cos_q / sin_q are just the current position's rows when decoding
+            cos, sin, cos_q, sin_q = pos_emb
             k = apply_rotary_emb(k, cos, sin)
-
-            if is_incremental_inference(context):
-                seq_dim = cos.shape.get_dim_by_name('sequence')
-                cos = mtf.gather(cos, context.position - 1, seq_dim)
-                sin = mtf.gather(sin, context.position - 1, seq_dim)
-
-            q = apply_rotary_emb(q, cos, sin)
+            q = apply_rotary_emb(q, cos_q, sin_q)
 
         with tf.variable_scope("attention"):
             if attention_type == "local":
@@ -206,7 +389,7 @@ def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_len
                 radius = params.get("local_attention_radius", 256)
 
                 if is_incremental_inference(context):
-                    q *= one_hot
+                    q *= context.position_one_hot
 
                 a = mtf_transformer.attention.local_attention_1d(
                     q, k, v,
@@ -225,36 +408,41 @@ def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_len
             elif attention_type == "global":
 
                 # TODO: pass in fake context
-                # Broadcast mask bias across batch and heads
-                if exists(bias):
-                    if not is_incremental_inference(context):
-                        broadcasted_bias = mtf.broadcast(bias, [dim_batch, dim_heads, bias.shape[-2], bias.shape[-1]])
-                    else:
-                        # In the incremental case, a custom mask needs to be built that masks out all key/values that are greater than the current position
-                        bias = mtf.gather(bias, context.position - 1, dim_seq)
-                        broadcasted_bias = mtf.broadcast(bias, [dim_batch, dim_heads, bias.shape[-1]])
-
-                # memory key / values, from all-attention paper
-                if use_num_mem_kv:
-                    k, v = memory_key_values(k, v, num_mem_kv, dim_batch, dim_heads, variable_dtype, mesh)
-
+                # The mask bias ([sequence, memory_length], or the [batch, memory_length] row for the current position
+                # when decoding - see biasmask_decode_attn_weights) is passed as is; adding it to the logits
+                # broadcasts it across batch and heads without materializing a [batch, heads, ...] copy
                 k = mtf.replace_dimensions(k, k.shape[1], memory_length_dim)
                 v = mtf.replace_dimensions(v, v.shape[1], memory_length_dim)
 
                 attn_dropout_rate = params["attn_dropout"] if params["mode"] == "train" else 0
 
-                a = mtf_transformer.attention.attention(
-                    q, k, v,
-                    memory_length_dim=memory_length_dim,
-                    key_dim=dim_kv,
-                    value_dim=dim_kv,
-                    bias=broadcasted_bias,
-                    dropout_rate=attn_dropout_rate
-                )
+                if use_num_mem_kv:
+                    # memory key / values, from all-attention paper
+                    mem_k, mem_v = memory_key_values(num_mem_kv, dim_heads, dim_kv, variable_dtype, mesh)
+                    a = attention_with_memory_kv(
+                        q, k, v, mem_k, mem_v,
+                        memory_length_dim=memory_length_dim,
+                        key_dim=dim_kv,
+                        value_dim=dim_kv,
+                        bias=bias,
+                        dropout_rate=attn_dropout_rate
+                    )
+                else:
+                    a = mtf_transformer.attention.attention(
+                        q, k, v,
+                        memory_length_dim=memory_length_dim,
+                        key_dim=dim_kv,
+                        value_dim=dim_kv,
+                        bias=bias,
+                        dropout_rate=attn_dropout_rate
+                    )
 
             elif attention_type == "linear":
-                linear_attn_fn = causal_linear_attention if params["causal"] else linear_attention
-                a = linear_attn_fn(q, k, v)
+                if params["causal"] and not is_incremental_inference(context):
+                    a = chunked_causal_linear_attention(q, k, v, params.get("linear_attention_chunk_size", 64))
+                else:
+                    linear_attn_fn = causal_linear_attention if params["causal"] else linear_attention
+                    a = linear_attn_fn(q, k, v)
 
             else:
                 raise NotImplementedError("Unknown attention type {}!".format(attention_type))
@@ -304,7 +492,6 @@ def axial_positional_emb(embd_dim, mesh, params, variable_dtype):
     # Use axial position encoding
     axial_dim_1, axial_dim_2 = params["axial_pos_emb"]
 
-    axial_dim = mtf.Dimension("axial_dim", axial_dim_1 * axial_dim_2)
     dim_axials = [mtf.Dimension(f"axial_dim_{i}", t) for i, t in enumerate((axial_dim_1, axial_dim_2))]
 
     axial_wpe_1 = mtf.get_variable(mesh, "axial_wpe_1", mtf.Shape([dim_axials[0], embd_dim]),
@@ -319,13 +506,18 @@ def axial_positional_emb(embd_dim, mesh, params, variable_dtype):
                                    slice_dtype=variable_dtype.slice_dtype,
                                    activation_dtype=variable_dtype.activation_dtype)
 
-    axial_wpe_1, axial_wpe_2 = map(lambda t: mtf.broadcast(t, [dim_axials[0], dim_axials[1], embd_dim]),
-                                   (axial_wpe_1, axial_wpe_2))
-    wpe = (axial_wpe_1 + axial_wpe_2) / 2
+    # The full [axial_dim_1 * axial_dim_2, embd] table is never built - see axial_positional_emb_lookup
+    return axial_wpe_1, axial_wpe_2
 
-    wpe = mtf.reshape(wpe, [axial_dim, embd_dim])
 
-    return wpe
+def axial_positional_emb_lookup(wpe, position_indices, params):
+    # Position p of the (flattened) axial table is the mean of row p // axial_dim_2 of axial_wpe_1 and row
+    # p % axial_dim_2 of axial_wpe_2
+    axial_wpe_1, axial_wpe_2 = wpe
+    axial_dim_2 = axial_wpe_2.shape[0].size
+    row_1 = embedding_lookup(axial_wpe_1, position_indices // axial_dim_2, axial_wpe_1.shape[0], params)
+    row_2 = embedding_lookup(axial_wpe_2, position_indices % axial_dim_2, axial_wpe_2.shape[0], params)
+    return (row_1 + row_2) / 2
 
 def rotary_positional_emb(mesh, sequence_dim, params, variable_dtype):
     dtype = variable_dtype.master_dtype
@@ -342,7 +534,9 @@ def rotary_positional_emb(mesh, sequence_dim, params, variable_dtype):
 
     freqs = mtf.concat((half_freqs, half_freqs), half_dim_head.name)
     freqs = mtf.rename_dimension(freqs, half_dim_head.name, dim_head.name)
-    return mtf.cos(freqs), mtf.sin(freqs)
+    # Angles in the master dtype - bf16 can't resolve the larger positions - but cos / sin multiply the activations
+    return mtf.cast(mtf.cos(freqs), variable_dtype.activation_dtype), \
+           mtf.cast(mtf.sin(freqs), variable_dtype.activation_dtype)
 
 def rotate_half(x):
     dim_head_name = "features_per_head"
@@ -87,6 +87,48 @@ def entmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
     return loss
 
 
+def softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
+    # mtf.layers.softmax_cross_entropy_with_logits for hard targets, rearranged as log_z - logits[target].
+    # mtf's version materializes log_softmax = logits - log_z over the whole vocab before picking out the targets;
+    # here only log_z and the target logits are computed from the [batch, seq, vocab] logits, and everything after
+    # (z_loss included) happens on [batch, seq].
+    if set(targets.shape.dims) != set(logits.shape.dims).difference([vocab_dim]):
+        raise ValueError(
+            "softmax_cross_entropy_with_logits with hard targets "
+            "dims in targets=%s should be dims in logits=%s other than "
+            "vocab_dim=%s" % (targets, logits, vocab_dim))
+
+    log_z = mtf.reduce_logsumexp(logits, vocab_dim)
+    target_logits = mtf.einsum([logits, mtf.one_hot(targets, vocab_dim, dtype=logits.dtype)],
+                               output_shape=targets.shape)
+    loss = log_z - target_logits
+    if z_loss != 0:
+        loss += z_loss * mtf.square(log_z)
+    return loss
+
+
+def sparse_softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
+    # softmax_cross_entropy_with_logits as a slicewise tf.nn.sparse_softmax_cross_entropy_with_logits, which reads the
+    # integer targets directly instead of building a one-hot [batch, seq, vocab] targets tensor.
+    # Only valid if vocab_dim is not split across the mesh.
+    if logits.shape.dims[-1] != vocab_dim:
+        logits = mtf.transpose(logits, (logits.shape - vocab_dim) + [vocab_dim])
+    if targets.shape != logits.shape - vocab_dim:
+        targets = mtf.transpose(targets, logits.shape - vocab_dim)
+
+    def xent_fn(logits, targets):
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets, logits=logits)
+        if z_loss != 0:
+            loss += z_loss * tf.square(tf.reduce_logsumexp(logits, axis=-1))
+        return loss
+
+    return mtf.slicewise(xent_fn, [logits, targets],
+                         output_shape=targets.shape,
+                         output_dtype=logits.dtype,
+                         splittable_dims=targets.shape.dims,
+                         name="sparse_softmax_cross_entropy_with_logits")
+
+
 def sample_categorical(x, dim=None):
     dim = x.shape[-1] if dim is None else dim
 
@@ -110,6 +152,18 @@ def biasmask_attn_weights(mesh, nd, ns, variable_dtype):
     return mtf.cast(mtf.less(i, j), dtype) * -1e10
 
 
+def biasmask_decode_attn_weights(mesh, position, nd, ns, variable_dtype):
+    # Single query row of biasmask_attn_weights for incremental decoding.
+    # Only the token at `position` queries the cached keys / values, so rather than gathering its row out of the full
+    # [nd, ns] mask in every layer, build the row directly. Returns shape [batch, memory_length]
+    i = position + ns.size - nd.size
+    j = mtf.range(mesh, ns, tf.int32)
+    shape = mtf.Shape(position.shape.dims + [ns])
+    i, j = map(lambda t: mtf.broadcast(t, shape), (i, j))
+    dtype = variable_dtype.activation_dtype
+    return mtf.cast(mtf.less(i, j), dtype) * -1e10
+
+
 def parse_inputs(mtf_features, other_features):
     # Parse inputs and labels from the mtf_features / other_features input dicts
     # All dimensions are defined inside model_fn for efficiency
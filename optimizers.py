@@ -88,6 +88,8 @@ def get_optimizer(mesh, loss, params, variable_dtype, inp_var_grads=None):
     if params["gradient_clipping"] is not None:
         (var_grads_fp, _) = clip_by_global_norm(var_grads_fp, clip_norm=clip_value)
 
+    # apply_grads merges the per-variable Assign ops into one grouped Assign per assign fn (graph.combine_assignments),
+    # so only a handful of update ops get lowered regardless of the number of variables
     update_ops = optimizer.apply_grads(var_grads_fp, mesh.graph.trainable_variables)
     return learning_rate, update_ops, var_grads_fp
 
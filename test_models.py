@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 import traceback
 import logging
@@ -10,10 +11,17 @@ import mesh_tensorflow as mtf
 from mesh_tensorflow import placement_mesh_impl
 
 from inputs import mlm_sample_text
+from model_fns import model_fn
+from models.activations import get_activation_fn
 from models.gpt2 import gpt2
-from models.utils import biasmask_attn_weights, entmax, sample_categorical
+from models.layers import attention_with_memory_kv, axial_positional_emb, axial_positional_emb_lookup, \
+    causal_linear_attention, chunked_causal_linear_attention, embedding_lookup, norm, write_kv_slot, \
+    FusedQKVAttentionParams
+from models.utils import biasmask_attn_weights, biasmask_decode_attn_weights, entmax, sample_categorical, \
+    softmax_cross_entropy_with_logits, sparse_softmax_cross_entropy_with_logits
 
 from sample import sample_autoregressive
+from utils import tensor_parallel_mesh
 
 # helper functions
 
@@ -25,6 +33,19 @@ def not_raises(exception):
         logging.error(traceback.format_exc())
         raise pytest.fail("DID RAISE {0}".format(exception))
 
+def import_random(mesh, *dims, dtype=np.float32):
+    values = np.random.randn(*[d.size for d in dims]).astype(dtype)
+    return values, mtf.import_tf_tensor(mesh, tf.constant(values), mtf.Shape(list(dims)))
+
+def export_numpy(graph, mesh, *tensors):
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    tensors = [lowering.export_to_tf_tensor(t) for t in tensors]
+    if tf.executing_eagerly():
+        return [t.numpy() for t in tensors]
+    with tf.compat.v1.Session() as sess:
+        return sess.run(tensors)
+
 # fixtures
 
 params = defaultdict(lambda: None, {
@@ -56,7 +77,12 @@ params = defaultdict(lambda: None, {
 
 # tests
 
-def test_model():
+# mixed_bfloat16 precision - fp32 variables, bf16 activations
+variable_dtypes = [mtf.VariableDType(tf.float32, tf.float32, tf.float32),
+                   mtf.VariableDType(tf.float32, tf.float32, tf.bfloat16)]
+
+@pytest.mark.parametrize("variable_dtype", variable_dtypes)
+def test_model(variable_dtype):
     graph = mtf.Graph()
     mesh = mtf.Mesh(graph, "my_mesh")
 
@@ -72,15 +98,13 @@ def test_model():
 
     # create mask
 
-    num_mem_kv = params.get('num_mem_kv', 0)
     length_dim = mtf.Dimension('sequence', seq_len)
-    memory_length_dim = mtf.Dimension('memory_length', seq_len + num_mem_kv)
+    memory_length_dim = mtf.Dimension('memory_length', seq_len)
     embed_sequence_dim = mtf.Dimension('embed_sequence', seq_len)
     embd_dim = mtf.Dimension("embd", params["n_embd"])
     vocab_dim = mtf.Dimension("vocab", params["n_vocab"])
 
     other_features = {}
-    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
 
     other_features["attn_bias"] = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype)
     other_features["embd_dim"] = embd_dim
@@ -96,7 +120,8 @@ def test_model():
         logits = lowering.export_to_tf_tensor(logits)
 
 
-def test_sampling():
+@pytest.mark.parametrize("variable_dtype", variable_dtypes)
+def test_sampling(variable_dtype):
     graph = mtf.Graph()
     mesh = mtf.Mesh(graph, "my_mesh")
 
@@ -109,16 +134,15 @@ def test_sampling():
     # create mask
 
     seq_len = params["n_ctx"]
-    num_mem_kv = params.get('num_mem_kv', 0)
     length_dim = mtf.Dimension('sequence', seq_len)
-    memory_length_dim = mtf.Dimension('memory_length', seq_len + num_mem_kv)
+    memory_length_dim = mtf.Dimension('memory_length', seq_len)
     embed_sequence_dim = mtf.Dimension('embed_sequence', seq_len)
     embd_dim = mtf.Dimension("embd", params["n_embd"])
     vocab_dim = mtf.Dimension("vocab", params["n_vocab"])
 
     other_features = {}
 
-    other_features["attn_bias"] = biasmask_attn_weights(mesh, length_dim, memory_length_dim, mtf.VariableDType(tf.float32))
+    other_features["attn_bias"] = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype)
     other_features["embd_dim"] = embd_dim
     other_features["vocab_dim"] = vocab_dim
     other_features["embed_sequence_dim"] = embed_sequence_dim
@@ -128,7 +152,7 @@ def test_sampling():
 
     with not_raises(Exception):
         samples = sample_autoregressive(
-            inputs, other_features=other_features, params=params, variable_dtype=mtf.VariableDType(),
+            inputs, other_features=other_features, params=params, variable_dtype=variable_dtype,
             remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=params["eos_id"], sampling_use_entmax=True)
 
         mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
@@ -178,3 +202,284 @@ def test_entmax():
     lowering = mtf.Lowering(graph, {mesh: mesh_impl})
     sample = lowering.export_to_tf_tensor(sample)
     grad = lowering.export_to_tf_tensor(grad)
+
+# norm
+
+def test_norm_precision():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    embd_dim = mtf.Dimension("embd", 64)
+
+    # large mean, tiny spread - the case where a one-pass E[x^2] - E[x]^2 cancels away the variance
+    values, x = import_random(mesh, batch_dim, embd_dim)
+    output, = export_numpy(graph, mesh, norm(x * 0.01 + 300., embd_dim))
+
+    values = 300. + 0.01 * values.astype(np.float64)
+    centred = values - values.mean(axis=-1, keepdims=True)
+    expected = centred / np.sqrt((centred ** 2).mean(axis=-1, keepdims=True) + 1e-8)
+    np.testing.assert_allclose(output, expected, atol=1e-2)
+
+# memory key / values
+
+def test_attention_with_memory_kv():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+
+    seq_len, num_mem_kv = 4, 3
+    batch_dim = mtf.Dimension("batch", 2)
+    length_dim = mtf.Dimension("sequence", seq_len)
+    memory_length_dim = mtf.Dimension("memory_length", seq_len)
+    dim_mem_kv = mtf.Dimension("mem_kv_sequence", num_mem_kv)
+    heads_dim = mtf.Dimension("heads", 2)
+    kv_dim = mtf.Dimension("features_per_head", 5)
+
+    q_np, q = import_random(mesh, batch_dim, length_dim, heads_dim, kv_dim)
+    k_np, k = import_random(mesh, batch_dim, memory_length_dim, heads_dim, kv_dim)
+    v_np, v = import_random(mesh, batch_dim, memory_length_dim, heads_dim, kv_dim)
+    mem_k_np, mem_k = import_random(mesh, dim_mem_kv, heads_dim, kv_dim)
+    mem_v_np, mem_v = import_random(mesh, dim_mem_kv, heads_dim, kv_dim)
+
+    bias = biasmask_attn_weights(mesh, length_dim, memory_length_dim, mtf.VariableDType(tf.float32))
+    output = attention_with_memory_kv(q, k, v, mem_k, mem_v, memory_length_dim, kv_dim, kv_dim, bias=bias)
+    output, = export_numpy(graph, mesh, mtf.transpose(output, q.shape))
+
+    # reference - broadcast the memory across the batch and concatenate it onto k / v, with the memory never masked
+    full_k = np.concatenate([np.broadcast_to(mem_k_np, (2,) + mem_k_np.shape), k_np], axis=1)
+    full_v = np.concatenate([np.broadcast_to(mem_v_np, (2,) + mem_v_np.shape), v_np], axis=1)
+    full_bias = np.concatenate([np.zeros((seq_len, num_mem_kv)), np.triu(np.full((seq_len, seq_len), -1e10), 1)], 1)
+    logits = np.einsum("bqhd,bkhd->bhqk", q_np, full_k) + full_bias
+    weights = np.exp(logits - logits.max(-1, keepdims=True))
+    weights /= weights.sum(-1, keepdims=True)
+    expected = np.einsum("bhqk,bkhd->bqhd", weights, full_v)
+    np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-5)
+
+# kv cache
+
+def test_write_kv_slot():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 3)
+    sequence_dim = mtf.Dimension("sequence", 4)
+    heads_dim = mtf.Dimension("heads", 2)
+    kv_dim = mtf.Dimension("features_per_head", 5)
+
+    _, old = import_random(mesh, batch_dim, sequence_dim, heads_dim, kv_dim)
+    _, new = import_random(mesh, batch_dim, heads_dim, kv_dim)
+    position = mtf.import_tf_tensor(mesh, tf.constant([0, 3, 1]), mtf.Shape([batch_dim]))
+
+    output = write_kv_slot(old, new, position, sequence_dim)
+
+    # the one-hot blend write_kv_slot replaces
+    one_hot = mtf.one_hot(position, sequence_dim, dtype=tf.float32)
+    expected = old * (1.0 - one_hot) + new * one_hot
+    expected = mtf.transpose(expected, old.shape)
+
+    output, expected = export_numpy(graph, mesh, output, expected)
+    np.testing.assert_array_equal(output, expected)
+
+# embedding
+
+def test_embedding_lookup():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    sequence_dim = mtf.Dimension("sequence", 4)
+    vocab_dim = mtf.Dimension("vocab", 8)
+    embd_dim = mtf.Dimension("embd", 3)
+
+    _, weights = import_random(mesh, vocab_dim, embd_dim)
+    indices = mtf.import_tf_tensor(mesh, tf.constant([[0, 7, 7, 2], [3, 0, 5, 5]]), mtf.Shape([batch_dim, sequence_dim]))
+    _, dy = import_random(mesh, batch_dim, sequence_dim, embd_dim)
+
+    output = embedding_lookup(weights, indices, vocab_dim, params)
+    expected = mtf.transpose(mtf.gather(weights, indices, vocab_dim), output.shape)
+    grad = mtf.gradients([output * dy], [weights])[0]
+    expected_grad = mtf.gradients([expected * dy], [weights])[0]
+
+    output, expected, grad, expected_grad = export_numpy(graph, mesh, output, expected, grad, expected_grad)
+    np.testing.assert_allclose(output, expected, rtol=1e-6)
+    np.testing.assert_allclose(grad, expected_grad, rtol=1e-6)
+
+# activations
+
+def test_gelu():
+    # mtf.cwise without a grad_function falls back to tf.gradients, which needs graph mode
+    with tf.Graph().as_default():
+        graph = mtf.Graph()
+        mesh = mtf.Mesh(graph, "my_mesh")
+        batch_dim = mtf.Dimension("batch", 4)
+        features_dim = mtf.Dimension("features", 16)
+
+        _, x = import_random(mesh, batch_dim, features_dim)
+        x *= 4.  # cover the tails as well as the region around 0
+
+        output = get_activation_fn({"activation_fn": "gelu"})(x)
+        expected = mtf.gelu(x)
+        grad = mtf.gradients([mtf.reduce_sum(output)], [x])[0]
+        expected_grad = mtf.gradients([mtf.reduce_sum(expected)], [x])[0]
+
+        output, expected, grad, expected_grad = export_numpy(graph, mesh, output, expected, grad, expected_grad)
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(grad, expected_grad, rtol=1e-5, atol=1e-6)
+
+# loss
+
+@pytest.mark.parametrize("xent_fn", [softmax_cross_entropy_with_logits, sparse_softmax_cross_entropy_with_logits])
+@pytest.mark.parametrize("z_loss", [0.0, 1e-4])
+def test_softmax_cross_entropy_with_logits(xent_fn, z_loss):
+    # slicewise ops without a grad_function (the sparse loss) fall back to tf.gradients, which needs graph mode
+    with tf.Graph().as_default():
+        graph = mtf.Graph()
+        mesh = mtf.Mesh(graph, "my_mesh")
+        batch_dim = mtf.Dimension("batch", 2)
+        sequence_dim = mtf.Dimension("sequence", 4)
+        vocab_dim = mtf.Dimension("vocab", 16)
+
+        _, logits = import_random(mesh, batch_dim, sequence_dim, vocab_dim)
+        targets = mtf.import_tf_tensor(mesh, tf.constant(np.random.randint(0, vocab_dim.size, (2, 4)), tf.int32),
+                                       mtf.Shape([batch_dim, sequence_dim]))
+
+        loss = xent_fn(logits, targets, vocab_dim, z_loss=z_loss)
+        expected = mtf.layers.softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=z_loss)
+        grad = mtf.gradients([loss], [logits])[0]
+        expected_grad = mtf.gradients([expected], [logits])[0]
+
+        loss, expected, grad, expected_grad = export_numpy(graph, mesh, loss, expected, grad, expected_grad)
+        np.testing.assert_allclose(loss, expected, rtol=1e-5)
+        np.testing.assert_allclose(grad, expected_grad, rtol=1e-5, atol=1e-7)
+
+# linear attention
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4, 12])
+def test_chunked_causal_linear_attention(chunk_size):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    sequence_dim = mtf.Dimension("sequence", 12)
+    heads_dim = mtf.Dimension("heads", 2)
+    kv_dim = mtf.Dimension("features_per_head", 3)
+
+    _, q = import_random(mesh, batch_dim, sequence_dim, heads_dim, kv_dim)
+    _, k = import_random(mesh, batch_dim, sequence_dim, heads_dim, kv_dim)
+    _, v = import_random(mesh, batch_dim, sequence_dim, heads_dim, kv_dim)
+
+    output = chunked_causal_linear_attention(q, k, v, chunk_size)
+    expected = causal_linear_attention(q, k, v)
+    output = mtf.transpose(output, expected.shape)
+
+    output, expected = export_numpy(graph, mesh, output, expected)
+    np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-5)
+
+# decode mask
+
+def test_biasmask_decode_attn_weights():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 4)
+    length_dim = mtf.Dimension("sequence", 4)
+    memory_length_dim = mtf.Dimension("memory_length", 4)
+    variable_dtype = mtf.VariableDType(tf.float32)
+
+    position = mtf.import_tf_tensor(mesh, tf.constant([0, 1, 2, 3]), mtf.Shape([batch_dim]))
+    output = biasmask_decode_attn_weights(mesh, position, length_dim, memory_length_dim, variable_dtype)
+
+    # the row of the full mask belonging to each example's position
+    bias = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype)
+    expected = mtf.transpose(mtf.gather(bias, position, length_dim), output.shape)
+
+    output, expected = export_numpy(graph, mesh, output, expected)
+    np.testing.assert_array_equal(output, expected)
+
+# axial positional embedding
+
+def test_axial_positional_emb_lookup():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    axial_params = defaultdict(lambda: None, {**params, "axial_pos_emb": (3, 4)})
+    batch_dim = mtf.Dimension("batch", 2)
+    sequence_dim = mtf.Dimension("sequence", 5)
+    embd_dim = mtf.Dimension("embd", 2)
+
+    wpe = axial_positional_emb(embd_dim, mesh, axial_params, mtf.VariableDType(tf.float32))
+    position_indices = mtf.import_tf_tensor(mesh, tf.constant([[0, 1, 4, 7, 11], [11, 10, 3, 5, 0]]),
+                                            mtf.Shape([batch_dim, sequence_dim]))
+    output = axial_positional_emb_lookup(wpe, position_indices, axial_params)
+
+    # the full [axial_dim_0 * axial_dim_1, embd] table the lookup avoids building
+    axial_wpe_1, axial_wpe_2 = wpe
+    axial_dim = mtf.Dimension("axial_dim", 12)
+    table_shape = [axial_wpe_1.shape[0], axial_wpe_2.shape[0], embd_dim]
+    table = (mtf.broadcast(axial_wpe_1, table_shape) + mtf.broadcast(axial_wpe_2, table_shape)) / 2
+    table = mtf.reshape(table, [axial_dim, embd_dim])
+    expected = mtf.transpose(mtf.gather(table, position_indices, axial_dim), output.shape)
+
+    output, expected = export_numpy(graph, mesh, output, expected)
+    np.testing.assert_allclose(output, expected, rtol=1e-6)
+
+# fused qkv
+
+def test_fused_qkv():
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    sequence_dim = mtf.Dimension("sequence", 4)
+    embd_dim = mtf.Dimension("embd", 6)
+    heads_dim = mtf.Dimension("heads", 2)
+    kv_dim = mtf.Dimension("features_per_head", 3)
+
+    _, x = import_random(mesh, batch_dim, sequence_dim, embd_dim)
+    mtfparams = FusedQKVAttentionParams(mesh, query_input_dim=embd_dim, memory_input_dim=embd_dim,
+                                        output_dim=embd_dim, key_dim=kv_dim, value_dim=kv_dim,
+                                        query_heads_dims=[heads_dim], memory_heads_dims=[heads_dim],
+                                        variable_dtype=mtf.VariableDType(tf.float32))
+    outputs = mtfparams.compute_qkv(x)
+
+    # the separate q / k / v projections, using the corresponding slices of the fused variable
+    mtfparams.wq, mtfparams.wk, mtfparams.wv = [mtf.gather(mtfparams.wqkv, i, mtfparams.dim_qkv) for i in range(3)]
+    expected = [mtfparams.compute_q(x), mtfparams.compute_k(x), mtfparams.compute_v(x)]
+    outputs = [mtf.transpose(t, e.shape) for t, e in zip(outputs, expected)]
+
+    results = export_numpy(graph, mesh, *outputs, *expected)
+    for output, expected in zip(results[:3], results[3:]):
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+
+# model_fn
+
+def test_model_fn_predict(tmp_path):
+    model_params = defaultdict(lambda: None, {
+        **params,
+        "model": "GPT",
+        "mesh_shape": "",
+        "layout": "",
+        "use_tpu": False,
+        "gpu_ids": [""],
+        "num_cores": 1,
+        "model_path": str(tmp_path),
+        "steps_per_checkpoint": 1,
+        "predict_batch_size": 1,
+        "sampling_use_entmax": False
+    })
+
+    # model_fn builds and lowers a graph, as it would under the estimator
+    with tf.Graph().as_default(), not_raises(Exception):
+        tf.compat.v1.train.get_or_create_global_step()
+        features = tf.ones([model_params["predict_batch_size"], model_params["n_ctx"]], tf.int32)
+        spec = model_fn(features, None, tf.estimator.ModeKeys.PREDICT, model_params)
+        assert spec.scaffold_fn() is spec.scaffold_fn()
+        assert isinstance(spec.prediction_hooks[0], mtf.MtfRestoreHook)
+
+
+# tensor parallel mesh
+
+def test_tensor_parallel_mesh():
+    mesh_shape, layout = tensor_parallel_mesh(8, 2, n_vocab=50304, n_head=16)
+    assert mesh_shape == "x:4,y:2"
+    assert sorted(layout.split(",")) == ["batch:x", "heads:y", "intermediate_expanded:y", "vocab:y"]
+
+    # the default 50257 vocab can't be split in two - it's replicated rather than failing at layout time
+    _, layout = tensor_parallel_mesh(8, 2, n_vocab=50257, n_head=16)
+    assert "vocab" not in layout
+
+    with pytest.raises(AssertionError):
+        tensor_parallel_mesh(8, 4, n_vocab=50304, n_head=6)
@@ -1,4 +1,6 @@
 import re
+import hashlib
+import json
 from urllib.parse import urlparse
 from shutil import rmtree
 import logging
@@ -64,6 +66,40 @@ def simd_mesh_setup(params, mesh_shape, layout_rules):
     return var_placer, mesh_impl
 
 
+def mesh_setup(params, mesh_shape, layout_rules):
+    """Returns the variable placer & mesh implementation for the TPU (SimdMesh) or GPU (PlacementMesh) case"""
+    if params["use_tpu"]:
+        return simd_mesh_setup(params, mesh_shape, layout_rules)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(mesh_shape, layout_rules, params["gpu_ids"])
+    # mtf puts master variables on cpu:0 unless given a placer - with a single device, keep them on it with everything
+    # else rather than copying them over every step
+    var_placer = mtf.utils.BalancedVariablePlacer(mesh_impl.devices) if mesh_impl.size == 1 else None
+    return var_placer, mesh_impl
+
+
+def tensor_parallel_mesh(num_cores, tensor_parallel_size, n_vocab, n_head):
+    """
+    Builds a 2-D mesh that splits the batch across data parallel replicas (x) and the heads, vocab and mlp
+    intermediate dimensions across tensor parallel replicas (y). Sharding vocab means the logits are never fully
+    materialized on a single core - the softmax cross entropy reduces over the split vocab dimension directly.
+    Vocab is only split if tensor_parallel_size divides it (the default 50257 isn't) - otherwise it's replicated.
+
+    :param num_cores: total number of cores in the mesh
+    :param tensor_parallel_size: number of cores each tensor is split across
+    :param n_vocab: vocab size
+    :param n_head: number of attention heads
+    :return: (mesh_shape, layout) strings
+    """
+    assert num_cores % tensor_parallel_size == 0, "tensor_parallel_size must divide the number of cores"
+    assert n_head % tensor_parallel_size == 0, \
+        f"tensor_parallel_size ({tensor_parallel_size}) must divide n_head ({n_head})"
+    mesh_shape = f"x:{num_cores // tensor_parallel_size},y:{tensor_parallel_size}"
+    layout = "batch:x,heads:y,intermediate_expanded:y"
+    if n_vocab % tensor_parallel_size == 0:
+        layout += ",vocab:y"
+    return mesh_shape, layout
+
+
 def remove_batch_from_layout(layout):
     """
     The tf-mesh layout splits across batch size, remove it.
@@ -222,16 +258,66 @@ def check_dataset(input_fn, params, global_step=None):
     exit()
 
 def auto_layout(graph, mesh_shape, logits, loss):
-    layout_rules = mtf.auto_mtf.layout(graph, mesh_shape, [logits, loss])
-    print(f"Auto-selected layout:\n{layout_rules}\nRe-initialize graph with selected layout")
-    quit() 
+    layout_rules = mtf.auto_mtf.layout(graph, mesh_shape, [t for t in (logits, loss) if t is not None])
+    print(f"Auto-selected layout:\n{layout_rules}")
+    return layout_rules
+
 
 def auto_layout_and_mesh_shape(graph, num_cores, logits, loss):
+    outputs = [t for t in (logits, loss) if t is not None]
     layout_rules, mesh_shape = mtf.auto_mtf.layout_and_mesh_shape(graph, num_cores,
-                                                                    [logits, loss], max_mesh_shape_dimensions=4)
-    print(f"Num cores:\n{num_cores}\nAuto-selected layout:\n{layout_rules}\nAuto-selected mesh shape:\n{mesh_shape}" \
-            f"\nRe-initialize graph with selected layout & mesh shape")
-    quit() 
+                                                                    outputs, max_mesh_shape_dimensions=4)
+    print(f"Num cores:\n{num_cores}\nAuto-selected layout:\n{layout_rules}\nAuto-selected mesh shape:\n{mesh_shape}")
+    return layout_rules, mesh_shape
+
+
+def auto_layout_cache_path(params):
+    """
+    Path of the file caching the auto-selected layout (and mesh shape) for this model / mesh configuration.
+
+    :param params: model params
+    :return: path inside params["model_path"]
+    """
+    key = (params["n_embd"], params["n_ctx"], params["n_vocab"], params["n_layer"], params["n_head"],
+           params["train_batch_size"], str(params["mesh_shape"]), params["num_cores"],
+           bool(params["auto_layout_and_mesh_shape"]))
+    digest = hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(params["model_path"], f"autolayout_{digest}.json")
+
+
+def save_auto_layout(params, layout_rules, mesh_shape):
+    """
+    Persists an auto-selected layout & mesh shape so later runs can skip the auto-mtf search.
+
+    :param params: model params
+    :param layout_rules: mtf.LayoutRules
+    :param mesh_shape: mtf.Shape
+    :return: None
+    """
+    layout = ";".join(f"{tensor_dim}:{mesh_dim.name}" for mesh_dim in mesh_shape.dims
+                      for tensor_dim in sorted(layout_rules.mesh_dimension_name_to_tensor_dimension_names(mesh_dim.name)))
+    mesh_shape_str = ",".join(f"{d.name}:{d.size}" for d in mesh_shape.dims)
+    path = auto_layout_cache_path(params)
+    with tf.io.gfile.GFile(path, "w") as f:
+        json.dump({"layout": layout, "mesh_shape": mesh_shape_str}, f)
+    tf.logging.info(f"Saved auto-selected layout to {path}")
+
+
+def load_auto_layout(params):
+    """
+    Loads a layout & mesh shape cached by save_auto_layout.
+
+    :param params: model params
+    :return: (mtf.LayoutRules, mtf.Shape), or None if nothing has been cached for this configuration
+    """
+    path = auto_layout_cache_path(params)
+    if not tf.io.gfile.exists(path):
+        return None
+    with tf.io.gfile.GFile(path, "r") as f:
+        cached = json.load(f)
+    tf.logging.info(f"Using cached auto-selected layout from {path}")
+    return mtf.convert_to_layout_rules(cached["layout"]), mtf.convert_to_shape(cached["mesh_shape"])
+
 
 def create_host_call(model_dir):
     """Construct a host_call writing scalar summaries.